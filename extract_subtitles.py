@@ -1,18 +1,22 @@
 #!/usr/bin/env python
 
+import os
 import pathlib
 import re
-import shlex
-import subprocess
 from typing import Any, Optional, TypedDict
 
 from subtitle_utils import (
+    compile_ep_pattern,
     extract_sub_lang_by_track_collection_with_video_sub_info,
     get_video_by_ep_collection_with_glob_and_pattern,
     get_video_collection_with_glob,
-    get_video_sub_info,
+    get_video_sub_info_by_video_collection,
+    print_cmd_collection,
+    probe_cache_filename,
     prompt_for_user_confirmation,
+    run_commands_concurrently,
     simple_ep_pattern,
+    split_suffix,
 )
 
 
@@ -22,8 +26,23 @@ class ExtractionMetadata(TypedDict, total=False):
         int, str
     ]  # Currently mandatory. Specified stream track should contain extractable subtitle stream. The string value (of the dict) will be used as extracted subtitle's language tag.
     target_video_glob: str  # Optional. If supplied, extracted subtitles will be renamed after another series of videos. If not supplied, origin_video_ep_pattern and target_video_ep_pattern will be ignored and extracted subtitles will be renamed after the original videos.
-    origin_video_ep_pattern: str  # Optional. Only used when targeting another series of videos to identify the episode info from the original video. (Default: simple_ep_pattern)
-    target_video_ep_pattern: str  # Optional. Only used when targeting another series of videos to identify the episode info from the targeting video. (Default: simple_ep_pattern)
+    origin_video_ep_pattern: str  # Optional. Only used when targeting another series of videos to identify the episode info from the original video. Searched anywhere in the file stem with the episode in the first group, so it needs no surrounding ".*". The first occurrence wins, start the pattern with ".*" to take the last one instead. (Default: simple_ep_pattern)
+    target_video_ep_pattern: str  # Optional. Only used when targeting another series of videos to identify the episode info from the targeting video. Searched anywhere in the file stem with the episode in the first group, so it needs no surrounding ".*". The first occurrence wins, start the pattern with ".*" to take the last one instead. (Default: simple_ep_pattern)
+
+
+sub_format_by_codec_name = {"subrip": "srt", "ass": "ass"}
+_ffmpeg_subtitle_cmd_prefix = (
+    "ffmpeg",
+    "-loglevel",
+    "warning",
+    "-n",  # do not overwrite
+)
+_ffmpeg_font_cmd_prefix = (
+    "ffmpeg",
+    "-dump_attachment:t",  # dump all attachments
+    "",  # with name guessed from attachments' filename field
+    "-n",  # do not overwrite
+)
 
 
 def extract_subtitles(
@@ -31,61 +50,98 @@ def extract_subtitles(
     sub_lang_by_track_collection: Optional[dict[int, str]] = None,
     target_video_by_ep_collection: Optional[dict[str, pathlib.Path]] = None,
     origin_video_ep_pattern: re.Pattern[str] = simple_ep_pattern,
+    jobs: Optional[int] = None,
+    probe_cache_file: Optional[pathlib.Path] = None,
 ) -> None:
     """
-    1. We first extract all the subtitle tracks from the origin video.
+    1. We first extract all the subtitle tracks from the origin videos, probing them concurrently.
+    Probe results are reused from probe_cache_file for videos that haven't changed since the last run.
     2. We then use the sub_lang_by_track_collection to map each sub_track to a subtitle language,
     which we can use to name the subtitle file.
-    3. We then use the origin_video_collection to generate the command for each sub_track,
-    and then use shlex.join to join the cmd tuple to a string, then print it to the terminal.
+    3. We then use the origin_video_collection to generate one command per video with an output for each sub_track,
+    and then use shlex.join to join the cmd tuples to strings, then print them to the terminal in one go.
+    Subtitles that already exist are skipped, and so are videos left without any subtitle to extract.
+    Subtitles that another video is already going to be extracted to are skipped too, so no two ffmpeg processes write the same file.
+    4. If user confirms, we run up to `jobs` (default: CPU count) ffmpeg processes in parallel.
     """
 
-    def _get_target_video() -> pathlib.Path:
+    def _get_target_video(origin_video: pathlib.Path) -> pathlib.Path:
         if target_video_by_ep_collection:
-            m = origin_video_ep_pattern.search(origin_video.stem)
+            m = origin_video_ep_pattern.search(split_suffix(origin_video.name)[0])
             if m:
                 return target_video_by_ep_collection[m[1]]
         return origin_video
 
-    def _get_sub_format() -> str:
-        codec_name = video_sub_info["streams"][sub_index]["codec_name"]
-        return {"subrip": "srt", "ass": "ass"}[codec_name]
+    def _get_sub_format(sub_stream_info: dict[str, Any]) -> str:
+        codec_name = sub_stream_info["codec_name"]
+        sub_format = sub_format_by_codec_name.get(codec_name)
+        if sub_format is None:
+            raise ValueError(
+                f"Unsupported subtitle codec {codec_name!r} in {origin_video}"
+            )
+        return sub_format
 
+    video_sub_info_by_video_collection = get_video_sub_info_by_video_collection(
+        origin_video_collection, jobs, probe_cache_file
+    )
     pending_subtitle_extraction: list[tuple[str, ...]] = []
+    pending_sub_path_set: set[str] = set()
     for origin_video in origin_video_collection:
-        video_sub_info = get_video_sub_info(origin_video)
+        video_sub_info = video_sub_info_by_video_collection[origin_video]
         if sub_lang_by_track_collection is None:
             sub_lang_by_track_collection = (
                 extract_sub_lang_by_track_collection_with_video_sub_info(video_sub_info)
             )
+        # Build the subtitle paths as plain strings, pathlib would re-parse the path for every sub_track.
+        target_video_base = str(_get_target_video(origin_video).with_suffix(""))
+        # Demux the video only once by writing every sub_track as a separate output of a single ffmpeg run.
+        #  Output options only apply to the output file following them, so they are repeated for each output.
+        output_args: list[str] = []
+        sub_stream_info_collection = video_sub_info["streams"]
         for sub_index, sub_lang in sub_lang_by_track_collection.items():
-            sub_path = _get_target_video().with_suffix(
-                f".{sub_lang}.{_get_sub_format()}"
-            )
-            cmd = (
-                "ffmpeg",
-                "-loglevel",
-                "warning",
-                "-i",  # input
-                str(
-                    origin_video
-                ),  # shlex.join only accept str, or we can use pathlike object directly here.
-                "-n",  # do not overwrite
-                "-codec",
-                "copy",
-                "-map",
-                f"0:s:{sub_index}",  # copy this sub_track from the input file
-                str(sub_path),
+            sub_format = _get_sub_format(sub_stream_info_collection[sub_index])
+            sub_path = f"{target_video_base}.{sub_lang}.{sub_format}"
+            if os.path.lexists(sub_path):
+                # With -n, ffmpeg would give up on every output of the command, not just this one.
+                # That includes directories and dangling symlinks, hence lexists rather than isfile.
+                print(f"Skip existing subtitle: {sub_path}")
+                continue
+            if sub_path in pending_sub_path_set:
+                # ffmpeg's own check for an existing file isn't atomic across concurrent processes.
+                print(f"Skip subtitle already extracted from another video: {sub_path}")
+                continue
+            pending_sub_path_set.add(sub_path)
+            output_args.extend(
+                (
+                    "-map",
+                    f"0:s:{sub_index}",  # copy this sub_track from the input file
+                    "-codec",
+                    "copy",
+                    sub_path,
+                )
             )
-            print(shlex.join(cmd))
-            pending_subtitle_extraction.append(cmd)
+        if not output_args:
+            continue
+        cmd = (
+            *_ffmpeg_subtitle_cmd_prefix,
+            "-i",  # input
+            str(
+                origin_video
+            ),  # shlex.join only accept str, or we can use pathlike object directly here.
+            *output_args,
+        )
+        pending_subtitle_extraction.append(cmd)
+    if not pending_subtitle_extraction:
+        print("No subtitle left to extract.")
+        return
+    print_cmd_collection(pending_subtitle_extraction)
     if prompt_for_user_confirmation("Start subtitle extraction?"):
-        for cmd in pending_subtitle_extraction:
-            subprocess.run(cmd)
+        run_commands_concurrently(pending_subtitle_extraction, jobs=jobs)
 
 
 def extract_fonts(
-    video_collection: tuple[pathlib.Path, ...], font_dir: Optional[pathlib.Path] = None
+    video_collection: tuple[pathlib.Path, ...],
+    font_dir: Optional[pathlib.Path] = None,
 ) -> None:
     if not video_collection:
         return
@@ -96,15 +152,12 @@ def extract_fonts(
         # When extracting we will run ffmpeg under another working directory to put all attachments into it.
         #  So we have to resolve the absolute path now.
         cmd = (
-            "ffmpeg",
-            "-dump_attachment:t",  # dump all attachments
-            "",  # with name guessed from attachments' filename field
-            "-n",  # do not overwrite
+            *_ffmpeg_font_cmd_prefix,
             "-i",  # input file url follows
             str(video.resolve()),
         )
-        print(shlex.join(cmd))
         pending_font_extraction.append(cmd)
+    print_cmd_collection(pending_font_extraction)
     assert isinstance(font_dir, pathlib.Path)
     if prompt_for_user_confirmation(f'Extract font to folder "{font_dir}?"'):
         if not font_dir.is_dir():
@@ -112,8 +165,9 @@ def extract_fonts(
                 755, True, True
             )  # This might raise a FileExistsError by design.
             # User should then take care of the existing file and re-run the script.
-        for cmd in pending_font_extraction:
-            subprocess.run(cmd, cwd=font_dir)
+        # Videos of a series usually embed fonts of the same names, and concurrent ffmpeg processes would write
+        #  the same file in font_dir at once since their "-n" check isn't atomic. So dump the fonts one video at a time.
+        run_commands_concurrently(pending_font_extraction, font_dir, jobs=1)
 
 
 if __name__ == "__main__":
@@ -133,19 +187,30 @@ if __name__ == "__main__":
         type=pathlib.Path,
         help='The directory containing source videos and "sub-utils.json", also the place to put extracted subtitles. (Default: current working directory)',
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="The maximum number of ffmpeg processes to run in parallel, at least 1. (Default: CPU count)",
+    )
     cli_args = parser.parse_args()
+    if cli_args.jobs is not None and cli_args.jobs < 1:
+        parser.error("argument -j/--jobs: must be a positive integer")
 
     # Read metadata
     metadata: ExtractionMetadata = {
         "origin_video_glob": "*.mkv",
         "sub_lang_by_track_collection": {0: "eng", 1: "enm"},
         # "target_video_glob": "*.mp4",
-        # "origin_video_ep_pattern": r".*\s(\d{2})\s.*",
-        # "target_video_ep_pattern": r".*\s(\d{2})\s.*",
+        # "origin_video_ep_pattern": r"\s(\d{2})\s",
+        # "target_video_ep_pattern": r"\s(\d{2})\s",
     }
 
     # Process
-    extraction_args: dict[str, Any] = {}
+    extraction_args: dict[str, Any] = {
+        "jobs": cli_args.jobs,
+        "probe_cache_file": cli_args.video_directory / probe_cache_filename,
+    }
     try:
         origin_video_collection = get_video_collection_with_glob(
             metadata["origin_video_glob"], cli_args.video_directory
@@ -158,7 +223,7 @@ if __name__ == "__main__":
         raise  # Explicitly catch and re-raise KeyError to comfort type checkers.
     if "target_video_glob" in metadata:
         target_video_ep_pattern = (
-            re.compile(metadata["target_video_ep_pattern"])
+            compile_ep_pattern(metadata["target_video_ep_pattern"])
             if "target_video_ep_pattern" in metadata
             else simple_ep_pattern
         )
@@ -170,7 +235,7 @@ if __name__ == "__main__":
             cli_args.video_directory,
         )
         origin_video_ep_pattern = (
-            re.compile(metadata["origin_video_ep_pattern"])
+            compile_ep_pattern(metadata["origin_video_ep_pattern"])
             if "origin_video_ep_pattern" in metadata
             else simple_ep_pattern
         )
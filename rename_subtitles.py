@@ -1,61 +1,183 @@
 #!/usr/bin/env python
 
-import json
+import collections
+import functools
+import operator
+import os
 import pathlib
 import re
-from typing import Dict, List, Pattern, Tuple, TypedDict
+import sys
+from typing import Callable, TypedDict
 
 from subtitle_utils import (
-    get_video_by_ep_collection_with_glob_and_pattern,
+    compile_ep_pattern,
+    dump_metadata,
+    get_full_suffix,
+    load_metadata,
+    metadata_filename,
     print_video_by_ep_collection,
     prompt_for_user_confirmation,
+    scan_video_directory,
     simple_ep_pattern,
-    metadata_filename,
+    split_suffix,
 )
 
 
 class RenamingMetadata(TypedDict):
-    subtitle_tag_by_glob_collection: Dict[
+    subtitle_tag_by_glob_collection: dict[
         str, str
     ]  # Optional. Used to collect subtitles to rename and given them a tag in the resulting name.Can be used to identify language or subtitle group. (Default: {"*.ass": "", "*.srt": ""})
     video_glob: str  # Optional. Used to collect videos to match. (Default: "*.mkv")
-    subtitle_ep_pattern: str  # Optional. Used to identify the episode info from the subtitle file. (Default: simple_ep_pattern)
-    video_ep_pattern: str  # Optional. Used to identify the episode info from the video file. (Default: simple_ep_pattern)
+    subtitle_ep_pattern: str  # Optional. Used to identify the episode info from the subtitle file. Searched anywhere in the file stem with the episode in the first group, so it needs no surrounding ".*". The first occurrence wins, start the pattern with ".*" to take the last one instead. (Default: simple_ep_pattern)
+    video_ep_pattern: str  # Optional. Used to identify the episode info from the video file. Searched anywhere in the file stem with the episode in the first group, so it needs no surrounding ".*". The first occurrence wins, start the pattern with ".*" to take the last one instead. (Default: simple_ep_pattern)
+
+
+def _get_conflicting_rename_operation_collection(
+    rename_operation_collection: list[tuple[str, str]],
+) -> list[tuple[str, str]]:
+    """
+    pick the operations that would replace another file of the collection: those sharing their new path with another
+    operation, and those renaming a file to the current path of another file of the collection.
+    """
+    normcase = os.path.normcase
+    dst_collection = [
+        normcase(os.path.join(os.path.dirname(file), new_name))
+        for file, new_name in rename_operation_collection
+    ]
+    src_set = {normcase(file) for file, _ in rename_operation_collection}
+    dst_count_by_dst_collection = collections.Counter(dst_collection)
+    return [
+        (file, new_name)
+        for (file, new_name), dst in zip(rename_operation_collection, dst_collection)
+        if dst_count_by_dst_collection[dst] > 1
+        or (dst in src_set and dst != normcase(file))
+    ]
+
+
+def _rename_all(
+    rename: Callable[[str, str], None],
+    rename_operation_collection: list[tuple[str, str]],
+) -> None:
+    """
+    Rename the files concurrently, as each rename costs a round-trip on network file systems.
+    Small batches are renamed serially to avoid the thread pool setup.
+    """
+    if len(rename_operation_collection) < 4:
+        for src, dst in rename_operation_collection:
+            rename(src, dst)
+        return
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(min(32, len(rename_operation_collection))) as executor:
+        # Exhaust the results so that any OSError is re-raised here.
+        for _ in executor.map(rename, *zip(*rename_operation_collection)):
+            pass
+
+
+def apply_rename_operations(rename_operation_collection: list[tuple[str, str]]) -> None:
+    """
+    Give each file path in the collection its new name, keeping it in its directory.
+    Where supported, every directory is opened only once and files are renamed relative to it,
+    so the kernel doesn't have to resolve the full path of both names for each file.
+    Nothing is renamed if a file would replace another one, see _get_conflicting_rename_operation_collection.
+    """
+    conflicting_rename_operation_collection = (
+        _get_conflicting_rename_operation_collection(rename_operation_collection)
+    )
+    if conflicting_rename_operation_collection:
+        file, new_name = conflicting_rename_operation_collection[0]
+        raise ValueError(f"Renaming {file} to {new_name} would replace another file")
+    if os.rename not in os.supports_dir_fd or not hasattr(os, "O_DIRECTORY"):
+        _rename_all(
+            os.rename,
+            [
+                (file, os.path.join(os.path.dirname(file), new_name))
+                for file, new_name in rename_operation_collection
+            ],
+        )
+        return
+    name_operation_collection_by_dir: dict[str, list[tuple[str, str]]] = {}
+    for file, new_name in rename_operation_collection:
+        directory, name = os.path.split(file)
+        name_operation_collection_by_dir.setdefault(directory, []).append(
+            (name, new_name)
+        )
+    for directory, name_operations in name_operation_collection_by_dir.items():
+        dir_fd = os.open(directory or os.curdir, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            _rename_all(
+                functools.partial(os.rename, src_dir_fd=dir_fd, dst_dir_fd=dir_fd),
+                name_operations,
+            )
+        finally:
+            os.close(dir_fd)
 
 
 def rename_subtitles(
-    video_stem_by_ep_collection: dict[str, pathlib.Path],
-    sub_glob: str = "*.ass",
-    sub_ep_pattern: Pattern[str] = simple_ep_pattern,
+    video_stem_by_ep_collection: dict[str, str],
+    sub_file_collection: list[pathlib.Path],
+    sub_ep_pattern: re.Pattern[str] = simple_ep_pattern,
     sub_lang: str = "",
-    working_directory: pathlib.Path = pathlib.Path(),
 ) -> None:
     """
-    1. Search for all subtitles matching the sub_glob pattern.
+    1. Take the subtitles collected with one of the subtitle globs.
     2. For each subtitle, see if there is a matching video file of the same episode.
     3. If there is a matching video file, then rename subtitle to
     the video file's stem + .<language> + .<file extension>
     4. Print each subtitle's name, its new name, and the video file's name.
-    5. Prompt user for confirmation to rename all the subtitles.
+    5. If any subtitle matched, prompt user for confirmation to rename all the subtitles.
     6. If user confirms, then rename all the subtitles.
     """
-    pending_rename_operation_collection: List[Tuple[pathlib.Path, str]] = []
-    print("Subtitles matched; Subtitles new name:")
-    for sub_file in working_directory.glob(sub_glob):
-        m = sub_ep_pattern.search(sub_file.stem)
-        if m and m[1] in video_stem_by_ep_collection:
-            sub_new_suffix = (
-                f".{sub_lang}{sub_file.suffix}"
-                if sub_lang
-                else "".join(sub_file.suffixes)
+    # Work on plain strings to avoid pathlib re-parsing the same names and paths over and over.
+    # Scans return files in directory order, only the table shown to the user is worth sorting.
+    sub_file_and_name_collection = sorted(
+        ((str(sub_file), sub_file.name) for sub_file in sub_file_collection),
+        key=operator.itemgetter(1),
+    )
+    # Bind the methods used for every subtitle to locals once.
+    search = sub_ep_pattern.search
+    get_video_stem = video_stem_by_ep_collection.get
+    # The language tag is the same for every subtitle, so it is formatted only once.
+    tag = f".{sub_lang}" if sub_lang else ""
+    pending_rename_operation_collection: list[tuple[str, str]] = []
+    for sub_file, sub_name in sub_file_and_name_collection:
+        sub_stem, sub_suffix = split_suffix(sub_name)
+        if (m := search(sub_stem)) and (video_stem := get_video_stem(m[1])) is not None:
+            sub_new_name = video_stem + (
+                tag + sub_suffix if tag else get_full_suffix(sub_name)
             )
-            video = video_stem_by_ep_collection[m[1]]
-            sub_new_name = video.stem + sub_new_suffix
-            print(sub_file.name, sub_new_name, sep=";\t")
             pending_rename_operation_collection.append((sub_file, sub_new_name))
-    if prompt_for_user_confirmation("Apply renaming?"):
+    if not pending_rename_operation_collection:
+        print("No subtitle matched any video.")
+        return
+    # Leave out the subtitles that would replace each other before asking, so the user confirms what will be done.
+    conflicting_rename_operation_set = set(
+        _get_conflicting_rename_operation_collection(
+            pending_rename_operation_collection
+        )
+    )
+    if conflicting_rename_operation_set:
+        print("Skip subtitles that would replace each other:")
         for sub_file, sub_new_name in pending_rename_operation_collection:
-            sub_file.rename(sub_file.with_name(sub_new_name))
+            if (sub_file, sub_new_name) in conflicting_rename_operation_set:
+                print(f"{os.path.basename(sub_file)};\t{sub_new_name}")
+        pending_rename_operation_collection = [
+            rename_operation
+            for rename_operation in pending_rename_operation_collection
+            if rename_operation not in conflicting_rename_operation_set
+        ]
+        if not pending_rename_operation_collection:
+            return
+    preview_line_collection = ["Subtitles matched; Subtitles new name:\n"]
+    preview_line_collection.extend(
+        f"{os.path.basename(sub_file)};\t{sub_new_name}\n"
+        for sub_file, sub_new_name in pending_rename_operation_collection
+    )
+    # Write the whole table at once, writelines would still write (and flush a line buffered tty) per line.
+    sys.stdout.write("".join(preview_line_collection))
+    sys.stdout.flush()
+    if prompt_for_user_confirmation("Apply renaming?"):
+        apply_rename_operations(pending_rename_operation_collection)
 
 
 if __name__ == "__main__":
@@ -80,31 +202,37 @@ if __name__ == "__main__":
     # Read metadata
     json_file: pathlib.Path = cli_args.video_directory / metadata_filename
     if json_file.is_file():
-        metadata: RenamingMetadata = json.loads(json_file.read_text())
+        metadata: RenamingMetadata = load_metadata(json_file)
     else:
         print("Metadata file doesn't exist.")
         metadata = {
-            "subtitle_ep_pattern": r".*\s(\d{2})\s.*",
+            "subtitle_ep_pattern": r"\s(\d{2})\s",
             "subtitle_tag_by_glob_collection": {"*.ass": "ja"},
-            "video_ep_pattern": r".*\s(\d{2})\s.*",
+            "video_ep_pattern": r"\s(\d{2})\s",
             "video_glob": "*.mkv",
         }
-        json_file.write_text(json.dumps(metadata, indent=2))
+        dump_metadata(metadata, json_file)
         print("Template created.")
         exit()
 
-    video_ep_pattern = re.compile(metadata["video_ep_pattern"])
-    subtitle_ep_pattern = re.compile(metadata["subtitle_ep_pattern"])
-    video_by_ep_collection = get_video_by_ep_collection_with_glob_and_pattern(
-        metadata["video_glob"], video_ep_pattern, cli_args.video_directory
+    video_ep_pattern = compile_ep_pattern(metadata["video_ep_pattern"])
+    subtitle_ep_pattern = compile_ep_pattern(metadata["subtitle_ep_pattern"])
+    subtitle_tag_by_glob_collection = metadata["subtitle_tag_by_glob_collection"]
+    video_by_ep_collection, subtitle_collection_by_glob = scan_video_directory(
+        metadata["video_glob"],
+        video_ep_pattern,
+        subtitle_tag_by_glob_collection,
+        cli_args.video_directory,
     )
     print_video_by_ep_collection(video_by_ep_collection)
     print()
-    for subtitle_glob, tag in metadata["subtitle_tag_by_glob_collection"].items():
+    video_stem_by_ep_collection = {
+        ep: split_suffix(video.name)[0] for ep, video in video_by_ep_collection.items()
+    }
+    for subtitle_glob, tag in subtitle_tag_by_glob_collection.items():
         rename_subtitles(
-            video_by_ep_collection,
-            subtitle_glob,
+            video_stem_by_ep_collection,
+            subtitle_collection_by_glob[subtitle_glob],
             subtitle_ep_pattern,
             tag,
-            cli_args.video_directory,
         )
@@ -1,14 +1,85 @@
 #!/usr/bin/env python
 
+import fnmatch
+import functools
+import io
 import itertools
 import json
+import os
 import pathlib
 import re
-import subprocess
-from typing import Any
+import sys
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+)
+
+# asyncio, subprocess and tempfile are imported where they are used, so code paths that never spawn a process
+#  (e.g. creating the metadata template) don't pay for importing them.
+if TYPE_CHECKING:
+    import asyncio
+
+try:
+    from orjson import OPT_INDENT_2, OPT_NON_STR_KEYS
+    from orjson import dumps as orjson_dumps
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional, fall back to the standard library.
+    from json import loads as json_loads
+
+    orjson_dumps = None
 
 simple_ep_pattern = re.compile(r"\s(\d{2})\s")
 metadata_filename = "sub-utils.json"
+probe_cache_filename = ".sub-utils-probe-cache.json"
+cmd_preview_limit = 100
+
+
+@functools.lru_cache(maxsize=None)
+def compile_pattern(pattern: str) -> re.Pattern[str]:
+    """compile the pattern only once no matter how many times it is requested"""
+    return re.compile(pattern)
+
+
+def compile_ep_pattern(pattern: str) -> re.Pattern[str]:
+    """
+    compile a pattern that will only be used with search() to pick the episode info from its first group.
+    A trailing ".*" can never change whether or where such a pattern matches, nor what its groups capture,
+    so it is dropped to spare the engine from consuming the rest of every name.
+    A leading ".*" is kept on purpose: it makes search() pick the last occurrence instead of the first one.
+    """
+    while pattern.endswith(".*"):
+        head = pattern[:-2]
+        if (len(head) - len(head.rstrip("\\"))) % 2:
+            break  # The "." is escaped and only matches literal dots.
+        pattern = head
+    return compile_pattern(pattern)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_metadata(metadata_file: str, mtime_ns: int) -> Any:
+    with open(metadata_file, "rb") as f:
+        return json_loads(f.read())
+
+
+def load_metadata(metadata_file: pathlib.Path) -> Any:
+    """parse the metadata JSON file, reusing the previous result while the file stays unmodified"""
+    return _load_metadata(str(metadata_file), metadata_file.stat().st_mtime_ns)
+
+
+def dump_metadata(metadata: Any, metadata_file: pathlib.Path) -> None:
+    """write the metadata JSON file indented for hand editing"""
+    if orjson_dumps is None:
+        data = json.dumps(metadata, indent=2).encode()
+    else:
+        # Like json.dumps, turn non-str keys (e.g. track numbers) into strings.
+        data = orjson_dumps(metadata, option=OPT_INDENT_2 | OPT_NON_STR_KEYS)
+    metadata_file.write_bytes(data)
 
 
 def print_video_by_ep_collection(
@@ -20,10 +91,117 @@ def print_video_by_ep_collection(
     )
 
 
+def split_suffix(name: str) -> tuple[str, str]:
+    """
+    split a file name into stem and suffix the same way as PurePath.stem and PurePath.suffix,
+    without the cost of constructing and parsing a path
+    """
+    i = name.rfind(".")
+    if 0 < i < len(name) - 1:
+        return name[:i], name[i:]
+    return name, ""
+
+
+def get_full_suffix(name: str) -> str:
+    """the same as "".join(PurePath(name).suffixes)"""
+    if name.endswith("."):
+        return ""
+    name = name.lstrip(".")
+    i = name.find(".")
+    return name[i:] if i != -1 else ""
+
+
+def _is_literal_glob(glob: str) -> bool:
+    """a glob without wildcards names a single file, which a stat finds without listing the whole directory"""
+    return not any(c in glob for c in "*?[")
+
+
+def _is_multi_segment_glob(glob: str) -> bool:
+    """a glob spanning directories can't match the names of a single listing, so it is left to pathlib"""
+    return "/" in glob or os.sep in glob
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_glob(glob: str) -> Callable[[str], Optional[re.Match[str]]]:
+    """translate the glob for matching os.path.normcase'd names, keeping the bound match method ready for hot loops"""
+    return compile_pattern(fnmatch.translate(os.path.normcase(glob))).match
+
+
+def iter_paths_with_glob(
+    glob: str, directory: pathlib.Path = pathlib.Path()
+) -> Iterator[pathlib.Path]:
+    """
+    yield the files directly inside directory whose name matches glob.
+    A single os.scandir pass is used, as DirEntry caches the file type and spares us the stat calls of Path.glob.
+    """
+    if _is_literal_glob(glob):
+        path = directory / glob
+        if path.is_file():
+            yield path
+        return
+    if _is_multi_segment_glob(glob):
+        yield from directory.glob(glob)
+        return
+    match = _compile_glob(glob)
+    normcase = os.path.normcase
+    with os.scandir(directory) as it:
+        for entry in it:
+            # Test the name first, is_file() may still need a stat call for symlinks and some file systems.
+            if match(normcase(entry.name)) and entry.is_file():
+                yield directory / entry.name
+
+
+def _get_name_collection_by_glob(
+    glob_collection: Iterable[str], directory: pathlib.Path
+) -> dict[str, list[str]]:
+    """
+    collect the names (relative to directory) of the files matching each glob, listing the directory at most once.
+    A file matching several globs is only collected for the first of them.
+    """
+    # Names are kept as plain strings while classifying, so no Path is built for entries that end up unused.
+    name_collection_by_glob: dict[str, list[str]] = {}
+    match_by_glob = {}
+    claimed_name_set: set[str] = set()
+    normcase = os.path.normcase
+    for glob in glob_collection:
+        name_collection_by_glob[glob] = []
+        if _is_multi_segment_glob(glob):
+            for path in iter_paths_with_glob(glob, directory):
+                name = str(path.relative_to(directory))
+                if normcase(name) not in claimed_name_set:
+                    claimed_name_set.add(normcase(name))
+                    name_collection_by_glob[glob].append(name)
+        else:
+            match_by_glob[glob] = _compile_glob(glob)
+    if all(map(_is_literal_glob, match_by_glob)):
+        for glob in match_by_glob:
+            if normcase(glob) not in claimed_name_set and (directory / glob).is_file():
+                claimed_name_set.add(normcase(glob))
+                name_collection_by_glob[glob].append(glob)
+        return name_collection_by_glob
+    with os.scandir(directory) as it:
+        for entry in it:
+            name = normcase(entry.name)
+            for glob, match in match_by_glob.items():
+                if match(name):
+                    if entry.is_file():
+                        name_collection_by_glob[glob].append(entry.name)
+                    break
+    return name_collection_by_glob
+
+
 def get_video_collection_with_glob(
     video_glob: str, video_dir: pathlib.Path = pathlib.Path()
 ) -> tuple[pathlib.Path, ...]:
-    return tuple(video_dir.glob(video_glob))
+    return tuple(iter_paths_with_glob(video_glob, video_dir))
+
+
+def _search_ep_in_name(
+    video_ep_pattern: re.Pattern[str], video_name: str
+) -> Optional[str]:
+    """the episode found in the stem of a file name, None if there is none"""
+    m = video_ep_pattern.search(split_suffix(video_name)[0])
+    return m[1] if m else None
 
 
 def generate_video_by_ep_collection_with_pattern(
@@ -32,9 +210,9 @@ def generate_video_by_ep_collection_with_pattern(
 ) -> dict[str, pathlib.Path]:
     video_by_ep_collection: dict[str, pathlib.Path] = {}
     for video in video_collection:
-        m = video_ep_pattern.search(video.stem)
-        if m:
-            video_by_ep_collection[m[1]] = video
+        ep = _search_ep_in_name(video_ep_pattern, video.name)
+        if ep is not None:
+            video_by_ep_collection[ep] = video
     return video_by_ep_collection
 
 
@@ -49,14 +227,98 @@ def get_video_by_ep_collection_with_glob_and_pattern(
     )
 
 
+def print_cmd_collection(
+    cmd_collection: Sequence[tuple[str, ...]], limit: int = cmd_preview_limit
+) -> None:
+    """print the first `limit` commands as shell command lines in a single write, and how many are left out"""
+    import shlex
+
+    buffer = io.StringIO()
+    for cmd in cmd_collection[:limit]:
+        buffer.write(shlex.join(cmd))
+        buffer.write("\n")
+    if len(cmd_collection) > limit:
+        buffer.write(f"... and {len(cmd_collection) - limit} more commands\n")
+    sys.stdout.write(buffer.getvalue())
+
+
+def scan_video_directory(
+    video_glob: str = "*.mkv",
+    video_ep_pattern: re.Pattern[str] = simple_ep_pattern,
+    sub_glob_collection: Iterable[str] = (),
+    video_dir: pathlib.Path = pathlib.Path(),
+) -> tuple[dict[str, pathlib.Path], dict[str, list[pathlib.Path]]]:
+    """
+    collect the videos by episode and the subtitles for each sub glob, listing video_dir only once.
+    A file matching both the video glob and a sub glob is taken as a video.
+    """
+    sub_glob_collection = tuple(sub_glob_collection)
+    name_collection_by_glob = _get_name_collection_by_glob(
+        (video_glob, *sub_glob_collection), video_dir
+    )
+    video_by_ep_collection: dict[str, pathlib.Path] = {}
+    for video_name in name_collection_by_glob[video_glob]:
+        ep = _search_ep_in_name(video_ep_pattern, os.path.basename(video_name))
+        if ep is not None:
+            # Only build a Path for videos with an episode.
+            video_by_ep_collection[ep] = video_dir / video_name
+    return video_by_ep_collection, {
+        sub_glob: [video_dir / name for name in name_collection_by_glob[sub_glob]]
+        for sub_glob in sub_glob_collection
+    }
+
+
 def prompt_for_user_confirmation(request_text: str) -> bool:
     user_input = input(request_text + " [Y/n] ")
     return user_input.lower() in ("", "y")
 
 
-def get_video_sub_info(video: pathlib.Path) -> Any:
-    """extract all subtitle info from the video with ffprobe"""
-    cmd = (
+def _get_job_count(jobs: Optional[int]) -> int:
+    """the number of processes to run at a time, the CPU count by default and never less than one"""
+    return max(1, jobs or os.cpu_count() or 1)
+
+
+async def _run(cmd: tuple[str, ...], cwd: Optional[pathlib.Path] = None) -> None:
+    import asyncio
+
+    # Detach stdin so concurrent ffmpeg processes don't fight over the terminal.
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, cwd=cwd, stdin=asyncio.subprocess.DEVNULL
+    )
+    await proc.wait()
+
+
+async def _run_all(
+    cmd_collection: Iterable[tuple[str, ...]],
+    cwd: Optional[pathlib.Path] = None,
+    jobs: Optional[int] = None,
+) -> None:
+    import asyncio
+
+    # A fixed number of workers pull from the same iterator, so each command is started as soon as it is produced
+    #  and a worker frees up, without creating a pending task per command up front.
+    cmd_iterator = iter(cmd_collection)
+
+    async def _worker() -> None:
+        for cmd in cmd_iterator:
+            await _run(cmd, cwd)
+
+    await asyncio.gather(*(_worker() for _ in range(_get_job_count(jobs))))
+
+
+def run_commands_concurrently(
+    cmd_collection: Iterable[tuple[str, ...]],
+    cwd: Optional[pathlib.Path] = None,
+    jobs: Optional[int] = None,
+) -> None:
+    """run independent commands in parallel, at most `jobs` (default: CPU count) at a time"""
+    import asyncio
+
+    asyncio.run(_run_all(cmd_collection, cwd, jobs))
+
+
+def _get_ffprobe_cmd(video: pathlib.Path) -> tuple[str, ...]:
+    return (
         "ffprobe",
         "-loglevel",
         "quiet",
@@ -65,9 +327,257 @@ def get_video_sub_info(video: pathlib.Path) -> Any:
         "-show_streams",
         "-select_streams",
         "s",
-        video,
+        str(video),
     )
-    return json.loads(subprocess.run(cmd, capture_output=True).stdout)
+
+
+# Matroska (EBML) element IDs, see https://www.matroska.org/technical/elements.html
+_ebml_id = 0x1A45DFA3
+_segment_id = 0x18538067
+_tracks_id = 0x1654AE6B
+_cluster_id = 0x1F43B675
+_track_entry_id = 0xAE
+_track_type_id = 0x83
+_codec_id_id = 0x86
+_language_id = 0x22B59C
+_language_bcp47_id = 0x22B59D
+_name_id = 0x536E
+_content_encodings_id = 0x6D80
+_subtitle_track_type = 0x11
+# Tracks are a few KiB even with large ASS headers, a bigger size means a corrupt file rather than a lot to read.
+_max_tracks_size = 1 << 24
+# Only the text subtitle codecs we know how ffmpeg names, anything else is left to ffprobe.
+codec_name_by_matroska_codec_id = {
+    "S_TEXT/UTF8": "subrip",
+    "S_TEXT/SSA": "ass",
+    "S_TEXT/ASS": "ass",
+    "S_SSA": "ass",
+    "S_ASS": "ass",
+}
+
+
+def _read_ebml_vint(f: BinaryIO, keep_marker: bool = False) -> tuple[int, int]:
+    """read an EBML variable-size integer, returning its value and its length in bytes"""
+    first = f.read(1)
+    if not first:
+        raise ValueError("Truncated EBML variable-size integer")
+    length = 9 - first[0].bit_length()
+    if length > 8:
+        raise ValueError("Invalid EBML variable-size integer")
+    rest = f.read(length - 1)
+    if len(rest) != length - 1:
+        raise ValueError("Truncated EBML variable-size integer")
+    value = first[0] if keep_marker else first[0] & (0xFF >> length)
+    return int.from_bytes(bytes((value,)) + rest, "big"), length
+
+
+def _read_ebml_data(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated EBML element")
+    return data
+
+
+def _iter_ebml_elements(
+    f: BinaryIO, end: Optional[int] = None
+) -> Iterator[tuple[int, Optional[int], int]]:
+    """
+    yield the id, size (None if unknown) and data position of each element until end (or EOF if end is None).
+    The file is positioned at the element data on each yield, and the next element is sought after resuming.
+    Raise ValueError for elements that are truncated or claim to be larger than what is left until end.
+    """
+    if end is None:
+        position = f.tell()
+        end = f.seek(0, io.SEEK_END)
+        f.seek(position)
+    while f.tell() < end:
+        element_id, _ = _read_ebml_vint(f, keep_marker=True)
+        size, length = _read_ebml_vint(f)
+        start = f.tell()
+        if size == (1 << 7 * length) - 1:
+            yield element_id, None, start
+            raise ValueError("Can't skip an EBML element of unknown size")
+        if start + size > end:
+            raise ValueError("Truncated EBML element")
+        yield element_id, size, start
+        f.seek(start + size)
+
+
+def _parse_matroska_tracks(tracks: bytes) -> dict[str, Any]:
+    f = io.BytesIO(tracks)
+    sub_info_collection: list[dict[str, Any]] = []
+    for element_id, size, start in _iter_ebml_elements(f, len(tracks)):
+        if element_id != _track_entry_id:
+            continue
+        if size is None:
+            raise ValueError("Matroska TrackEntry of unknown size")
+        field_by_id: dict[int, bytes] = {}
+        for field_id, field_size, _ in _iter_ebml_elements(f, start + size):
+            if field_size is None:
+                raise ValueError("Matroska TrackEntry field of unknown size")
+            field_by_id[field_id] = _read_ebml_data(f, field_size)
+        if (
+            int.from_bytes(field_by_id.get(_track_type_id, b""), "big")
+            != _subtitle_track_type
+        ):
+            continue
+        if _content_encodings_id in field_by_id or _language_bcp47_id in field_by_id:
+            # ffmpeg may drop (encrypted) or re-tag such tracks, leave them to ffprobe.
+            raise ValueError("Subtitle track needs ffprobe")
+        matroska_codec_id = field_by_id.get(_codec_id_id, b"").rstrip(b"\0").decode()
+        codec_name = codec_name_by_matroska_codec_id.get(matroska_codec_id)
+        if codec_name is None:
+            raise ValueError(f"Unknown subtitle codec {matroska_codec_id!r}")
+        tags = {}
+        # Same as ffmpeg: Language defaults to "eng" and "und" is not reported.
+        language = field_by_id.get(_language_id, b"eng").rstrip(b"\0").decode()
+        if language != "und":
+            tags["language"] = language
+        if _name_id in field_by_id:
+            tags["title"] = field_by_id[_name_id].rstrip(b"\0").decode()
+        sub_info_collection.append(
+            {"codec_type": "subtitle", "codec_name": codec_name, "tags": tags}
+        )
+    return {"streams": sub_info_collection}
+
+
+def read_matroska_sub_info(video: pathlib.Path) -> dict[str, Any]:
+    """
+    read the subtitle streams info straight from the Tracks element of a Matroska video,
+    in the same shape as ffprobe's output, without having to spawn ffprobe.
+    Raise ValueError for anything this minimal reader doesn't cover (other containers, unknown codecs, etc.).
+    """
+    with open(video, "rb") as f:
+        elements = _iter_ebml_elements(f)
+        if next(elements, (None,))[0] != _ebml_id:
+            raise ValueError("Not a Matroska file")
+        for element_id, size, start in elements:
+            if element_id == _segment_id:
+                break
+        else:
+            raise ValueError("Matroska Segment not found")
+        end = None if size is None else start + size
+        for element_id, size, _ in _iter_ebml_elements(f, end):
+            if element_id == _tracks_id and size is not None:
+                if size > _max_tracks_size:
+                    raise ValueError("Matroska Tracks too large")
+                return _parse_matroska_tracks(_read_ebml_data(f, size))
+            if element_id == _cluster_id:
+                break
+    raise ValueError("Matroska Tracks not found before the first Cluster")
+
+
+def get_video_sub_info(video: pathlib.Path) -> Any:
+    """extract all subtitle info from the video, reading Matroska headers directly or else with ffprobe"""
+    try:
+        return read_matroska_sub_info(video)
+    except ValueError:
+        pass
+    import subprocess
+
+    cmd = _get_ffprobe_cmd(video)
+    # Only stdout carries the JSON, ffprobe is told to stay quiet on stderr.
+    return json_loads(subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout)
+
+
+async def _probe(video: pathlib.Path, semaphore: "asyncio.Semaphore") -> Any:
+    import asyncio
+    import subprocess
+
+    try:
+        # Read the headers in a worker thread, so the videos are read concurrently rather than one after another.
+        return await asyncio.to_thread(read_matroska_sub_info, video)
+    except ValueError:
+        pass
+
+    async with semaphore:
+        proc = await asyncio.create_subprocess_exec(
+            *_get_ffprobe_cmd(video), stdout=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, _get_ffprobe_cmd(video))
+    return json_loads(stdout)
+
+
+async def _probe_all(
+    video_collection: tuple[pathlib.Path, ...], jobs: Optional[int] = None
+) -> dict[pathlib.Path, Any]:
+    import asyncio
+
+    semaphore = asyncio.Semaphore(_get_job_count(jobs))
+    video_sub_info_collection = await asyncio.gather(
+        *(_probe(video, semaphore) for video in video_collection)
+    )
+    return dict(zip(video_collection, video_sub_info_collection))
+
+
+def load_probe_cache(cache_file: pathlib.Path) -> dict[str, Any]:
+    try:
+        return json_loads(cache_file.read_bytes())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_probe_cache(cache_file: pathlib.Path, probe_cache: dict[str, Any]) -> None:
+    """write the cache, leaving out the videos that don't exist anymore"""
+    import tempfile
+
+    for key in [key for key in probe_cache if not os.path.exists(key)]:
+        del probe_cache[key]
+    # Write to a temporary file first so an interrupted run never leaves a truncated cache behind.
+    fd, temp_path = tempfile.mkstemp(
+        suffix=".tmp", prefix=cache_file.name, dir=cache_file.parent
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(probe_cache, f)
+        # mkstemp creates the file readable by its owner only, give it the usual mode for a new file instead.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0o666 & ~umask)
+        os.replace(temp_path, cache_file)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def get_video_sub_info_by_video_collection(
+    video_collection: tuple[pathlib.Path, ...],
+    jobs: Optional[int] = None,
+    cache_file: Optional[pathlib.Path] = None,
+) -> dict[pathlib.Path, Any]:
+    """
+    extract all subtitle info from every video like get_video_sub_info, probing the videos concurrently.
+    If cache_file is given, videos whose path, mtime and size match a cached entry are not probed again.
+    """
+    import asyncio
+
+    if cache_file is None:
+        return asyncio.run(_probe_all(video_collection, jobs))
+    probe_cache = load_probe_cache(cache_file)
+    video_sub_info_by_video_collection: dict[pathlib.Path, Any] = {}
+    cache_entry_by_video_collection: dict[pathlib.Path, tuple[str, dict[str, int]]] = {}
+    for video in video_collection:
+        stat = video.stat()
+        key = str(video.resolve())
+        stamp = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+        cached = probe_cache.get(key)
+        if cached and cached["stamp"] == stamp:
+            video_sub_info_by_video_collection[video] = cached["video_sub_info"]
+        else:
+            cache_entry_by_video_collection[video] = (key, stamp)
+    if cache_entry_by_video_collection:
+        probed = asyncio.run(_probe_all(tuple(cache_entry_by_video_collection), jobs))
+        for video, (key, stamp) in cache_entry_by_video_collection.items():
+            probe_cache[key] = {"stamp": stamp, "video_sub_info": probed[video]}
+        try:
+            save_probe_cache(cache_file, probe_cache)
+        except OSError as e:
+            # The cache only saves time on the next run, so a read-only video directory shouldn't stop this one.
+            print(f"Can't save the probe cache: {e}", file=sys.stderr)
+        video_sub_info_by_video_collection.update(probed)
+    return video_sub_info_by_video_collection
 
 
 def extract_sub_lang_by_track_collection_with_video_sub_info(
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import os
+import unittest
+
+from rename_subtitles import _get_conflicting_rename_operation_collection
+
+
+class GetConflictingRenameOperationCollectionTest(unittest.TestCase):
+    def test_no_conflict(self) -> None:
+        rename_operation_collection = [
+            (os.path.join("dir", "Sub 01 .GB.ass"), "Show 01 .chs.ass"),
+            (os.path.join("dir", "Sub 02 .GB.ass"), "Show 02 .chs.ass"),
+            (os.path.join("dir", "Show 03 .chs.ass"), "Show 03 .chs.ass"),
+            (os.path.join("other", "Sub 01 .GB.ass"), "Show 01 .chs.ass"),
+        ]
+        self.assertEqual(
+            _get_conflicting_rename_operation_collection(rename_operation_collection),
+            [],
+        )
+
+    def test_same_new_path(self) -> None:
+        rename_operation_collection = [
+            (os.path.join("dir", "[A] Show 01 .GB.ass"), "Show 01 .chs.ass"),
+            (os.path.join("dir", "[B] Show 01 .GB.ass"), "Show 01 .chs.ass"),
+            (os.path.join("dir", "Sub 02 .GB.ass"), "Show 02 .chs.ass"),
+        ]
+        self.assertEqual(
+            _get_conflicting_rename_operation_collection(rename_operation_collection),
+            rename_operation_collection[:2],
+        )
+
+    def test_renamed_onto_another_source(self) -> None:
+        rename_operation_collection = [
+            (os.path.join("dir", "Show 01 .ass"), "Show 02 .ass"),
+            (os.path.join("dir", "Show 02 .ass"), "Show 03 .ass"),
+        ]
+        self.assertEqual(
+            _get_conflicting_rename_operation_collection(rename_operation_collection),
+            rename_operation_collection[:1],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+import contextlib
+import io
+import os
+import pathlib
+import random
+import re
+import tempfile
+import unittest
+from typing import Optional
+from unittest import mock
+
+from subtitle_utils import (
+    compile_ep_pattern,
+    get_full_suffix,
+    get_video_sub_info_by_video_collection,
+    load_probe_cache,
+    read_matroska_sub_info,
+    save_probe_cache,
+    scan_video_directory,
+    simple_ep_pattern,
+    split_suffix,
+)
+
+_unknown_size = b"\x01\xff\xff\xff\xff\xff\xff\xff"
+
+
+def _element(element_id: int, data: bytes = b"", size: bytes = b"") -> bytes:
+    """encode an EBML element, with its size as an 8 byte vint unless given"""
+    return (
+        element_id.to_bytes((element_id.bit_length() + 7) // 8, "big")
+        + (size or b"\x01" + len(data).to_bytes(7, "big"))
+        + data
+    )
+
+
+def _track_entry(track_type: int, codec_id: str, *fields: bytes) -> bytes:
+    return _element(
+        0xAE,
+        _element(0x83, bytes((track_type,)))
+        + _element(0x86, codec_id.encode())
+        + b"".join(fields),
+    )
+
+
+_ebml_header = _element(0x1A45DFA3, _element(0x4282, b"matroska"))
+_info = _element(0x1549A966, _element(0x2AD7B1, b"\x0f\x42\x40"))
+_tracks = _element(
+    0x1654AE6B,
+    _track_entry(0x01, "V_MPEG4/ISO/AVC")
+    + _track_entry(
+        0x11, "S_TEXT/ASS", _element(0x22B59C, b"jpn"), _element(0x536E, b"Japanese")
+    )
+    + _track_entry(0x11, "S_TEXT/UTF8")
+    + _track_entry(0x11, "S_TEXT/UTF8", _element(0x22B59C, b"und\0")),
+)
+_cluster = _element(0x1F43B675, _element(0xE7, b"\x00") + _element(0xA3, b"\x81"))
+_expected_sub_info = {
+    "streams": [
+        {
+            "codec_type": "subtitle",
+            "codec_name": "ass",
+            "tags": {"language": "jpn", "title": "Japanese"},
+        },
+        {"codec_type": "subtitle", "codec_name": "subrip", "tags": {"language": "eng"}},
+        {"codec_type": "subtitle", "codec_name": "subrip", "tags": {}},
+    ]
+}
+
+
+def _search_ep(ep_pattern: re.Pattern[str], stem: str) -> Optional[str]:
+    m = ep_pattern.search(stem)
+    return m[1] if m else None
+
+
+class SimpleEpPatternTest(unittest.TestCase):
+    def test_episode(self) -> None:
+        for stem, ep in (
+            ("[Group] Show 01 [1080p]", "01"),
+            ("Show 12 END", "12"),
+            ("Show\t07\tx", "07"),
+            ("Show\u300003\u3000x", "03"),
+        ):
+            with self.subTest(stem=stem):
+                self.assertEqual(_search_ep(simple_ep_pattern, stem), ep)
+
+    def test_no_episode(self) -> None:
+        for stem in ("Show 001 x", "Show 1 x", "Show 01", "Show S01E01 x"):
+            with self.subTest(stem=stem):
+                self.assertIsNone(simple_ep_pattern.search(stem))
+
+    def test_first_occurrence_wins(self) -> None:
+        # Unlike the former default template r".*\s(\d{2})\s.*", which took the last occurrence.
+        stem = "Show 86 01 x"
+        self.assertEqual(_search_ep(simple_ep_pattern, stem), "86")
+        self.assertEqual(_search_ep(compile_ep_pattern(r".*\s(\d{2})\s.*"), stem), "01")
+
+
+class CompileEpPatternTest(unittest.TestCase):
+    def test_trailing_wildcards(self) -> None:
+        for pattern, compiled_pattern in (
+            (r"\s(\d{2})\s.*", r"\s(\d{2})\s"),
+            (r"\s(\d{2})\s.*.*", r"\s(\d{2})\s"),
+            (r"(\d{2})\.*", r"(\d{2})\.*"),
+            (r"(\d{2})\\.*", r"(\d{2})\\"),
+            (r"(\d{2})\\\.*", r"(\d{2})\\\.*"),
+            (r".*\s(\d{2})\s", r".*\s(\d{2})\s"),
+            (r".*\s(\d{2})\s.*", r".*\s(\d{2})\s"),
+        ):
+            with self.subTest(pattern=pattern):
+                self.assertEqual(compile_ep_pattern(pattern).pattern, compiled_pattern)
+
+    def test_same_episode(self) -> None:
+        for pattern in (r"\s(\d{2})\s.*", r".*\s(\d{2})\s.*", r"(\d{2})\.*"):
+            for stem in ("Show 01 x", "Show 86 01 x", "Show 01... x", "Show"):
+                with self.subTest(pattern=pattern, stem=stem):
+                    self.assertEqual(
+                        _search_ep(compile_ep_pattern(pattern), stem),
+                        _search_ep(re.compile(pattern), stem),
+                    )
+
+
+class SuffixTest(unittest.TestCase):
+    names = (
+        "Show 01 .ass",
+        "Show 01 .chs.ass",
+        "Show 01 x.mkv",
+        "Show",
+        ".hidden",
+        ".hidden.ass",
+        "..a.b",
+        "a.",
+        "a..b",
+        "a.b.",
+        "...",
+    )
+
+    def test_split_suffix(self) -> None:
+        for name in self.names:
+            path = pathlib.PurePath(name)
+            with self.subTest(name=name):
+                self.assertEqual(split_suffix(name), (path.stem, path.suffix))
+
+    def test_get_full_suffix(self) -> None:
+        for name in self.names:
+            with self.subTest(name=name):
+                self.assertEqual(
+                    get_full_suffix(name), "".join(pathlib.PurePath(name).suffixes)
+                )
+
+
+class ScanVideoDirectoryTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.directory = pathlib.Path(temp_dir.name)
+        for name in (
+            "Show 01 .mkv",
+            "Show 02 .mkv",
+            "Sub 01 .GB.ass",
+            "Sub 02 .GB.ass",
+        ):
+            (self.directory / name).touch()
+        (self.directory / "Sub 03 .GB.ass").mkdir()
+
+    def scan(self, *sub_glob_collection: str) -> dict[str, list[str]]:
+        video_by_ep_collection, sub_file_collection_by_glob = scan_video_directory(
+            sub_glob_collection=sub_glob_collection, video_dir=self.directory
+        )
+        self.assertEqual(
+            {ep: video.name for ep, video in video_by_ep_collection.items()},
+            {"01": "Show 01 .mkv", "02": "Show 02 .mkv"},
+        )
+        return {
+            sub_glob: sorted(sub_file.name for sub_file in sub_file_collection)
+            for sub_glob, sub_file_collection in sub_file_collection_by_glob.items()
+        }
+
+    def test_first_matching_glob_wins(self) -> None:
+        self.assertEqual(
+            self.scan("Sub 01 .GB.ass", "*.ass"),
+            {"Sub 01 .GB.ass": ["Sub 01 .GB.ass"], "*.ass": ["Sub 02 .GB.ass"]},
+        )
+        self.assertEqual(
+            self.scan("*.ass", "Sub 01 .GB.ass"),
+            {"*.ass": ["Sub 01 .GB.ass", "Sub 02 .GB.ass"], "Sub 01 .GB.ass": []},
+        )
+
+    def test_literal_globs(self) -> None:
+        self.assertEqual(
+            self.scan("Sub 01 .GB.ass", "Sub 03 .GB.ass", "Sub 04 .GB.ass"),
+            {
+                "Sub 01 .GB.ass": ["Sub 01 .GB.ass"],
+                "Sub 03 .GB.ass": [],
+                "Sub 04 .GB.ass": [],
+            },
+        )
+
+
+class ReadMatroskaSubInfoTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.video = pathlib.Path(temp_dir.name) / "video.mkv"
+
+    def read(self, data: bytes) -> dict:
+        self.video.write_bytes(data)
+        return read_matroska_sub_info(self.video)
+
+    def test_tracks(self) -> None:
+        video = _ebml_header + _element(0x18538067, _info + _tracks + _cluster)
+        self.assertEqual(self.read(video), _expected_sub_info)
+
+    def test_unknown_size_segment(self) -> None:
+        video = _ebml_header + _element(
+            0x18538067, _info + _tracks + _cluster, _unknown_size
+        )
+        self.assertEqual(self.read(video), _expected_sub_info)
+
+    def test_unknown_size_cluster_after_tracks(self) -> None:
+        cluster = _element(0x1F43B675, _element(0xE7, b"\x00"), _unknown_size)
+        video = _ebml_header + _element(0x18538067, _info + _tracks + cluster)
+        self.assertEqual(self.read(video), _expected_sub_info)
+
+    def test_tracks_after_cluster(self) -> None:
+        video = _ebml_header + _element(0x18538067, _info + _cluster + _tracks)
+        with self.assertRaises(ValueError):
+            self.read(video)
+
+    def test_not_matroska(self) -> None:
+        for data in (b"", b"\x00\x00\x00\x20ftypisom", _element(0x1F43B675)):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                self.read(data)
+
+    def test_tracks_left_to_ffprobe(self) -> None:
+        for track_entry in (
+            _track_entry(0x11, "S_HDMV/PGS"),
+            _track_entry(0x11, "S_TEXT/ASS", _element(0x6D80)),
+            _track_entry(0x11, "S_TEXT/ASS", _element(0x22B59D, b"ja-JP")),
+        ):
+            video = _ebml_header + _element(
+                0x18538067, _element(0x1654AE6B, track_entry)
+            )
+            with self.subTest(track_entry=track_entry), self.assertRaises(ValueError):
+                self.read(video)
+
+    def test_truncated(self) -> None:
+        video = _ebml_header + _element(0x18538067, _info + _tracks + _cluster)
+        for length in range(len(video)):
+            with self.subTest(length=length), self.assertRaises(ValueError):
+                self.read(video[:length])
+
+    def test_truncated_after_element_id(self) -> None:
+        with self.assertRaises(ValueError):
+            self.read(bytes.fromhex("1a45dfa380 18538067"))
+
+    def test_oversized_elements(self) -> None:
+        huge_size = b"\x01\x00\x00\x10\x00\x00\x00\x00"
+        for video in (
+            _ebml_header + _element(0x18538067, _tracks, huge_size),
+            _ebml_header
+            + _element(0x18538067, _element(0x1654AE6B, size=huge_size), _unknown_size),
+            _ebml_header
+            + _element(0x18538067, _element(0xEC, size=huge_size) + _tracks),
+        ):
+            with self.subTest(video=video), self.assertRaises(ValueError):
+                self.read(video)
+
+    def test_garbage_after_header(self) -> None:
+        # Whatever follows the EBML header, the reader either succeeds or raises ValueError (so ffprobe is used).
+        rng = random.Random(0)
+        for _ in range(2000):
+            data = _ebml_header + rng.randbytes(rng.randrange(1, 32))
+            with self.subTest(data=data):
+                try:
+                    self.read(data)
+                except ValueError:
+                    pass
+
+
+class ProbeCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.directory = pathlib.Path(temp_dir.name)
+        self.cache_file = self.directory / ".probe-cache.json"
+        self.video = self.directory / "video.mkv"
+        self.video.write_bytes(
+            _ebml_header + _element(0x18538067, _info + _tracks + _cluster)
+        )
+
+    @unittest.skipUnless(os.name == "posix", "file modes are POSIX only")
+    def test_save_honours_umask(self) -> None:
+        umask = os.umask(0o022)
+        try:
+            save_probe_cache(self.cache_file, {})
+        finally:
+            os.umask(umask)
+        self.assertEqual(self.cache_file.stat().st_mode & 0o777, 0o644)
+
+    def test_save_drops_missing_videos(self) -> None:
+        entry = {"stamp": {}, "video_sub_info": {"streams": []}}
+        missing_video = str(self.directory / "missing.mkv")
+        save_probe_cache(
+            self.cache_file, {str(self.video): entry, missing_video: entry}
+        )
+        self.assertEqual(load_probe_cache(self.cache_file), {str(self.video): entry})
+
+    def test_unwritable_cache_is_skipped(self) -> None:
+        stderr = io.StringIO()
+        with mock.patch(
+            "subtitle_utils.save_probe_cache", side_effect=PermissionError
+        ), contextlib.redirect_stderr(stderr):
+            video_sub_info_by_video_collection = get_video_sub_info_by_video_collection(
+                (self.video,), cache_file=self.cache_file
+            )
+        self.assertEqual(
+            video_sub_info_by_video_collection, {self.video: _expected_sub_info}
+        )
+        self.assertIn("probe cache", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()